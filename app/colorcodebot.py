@@ -2,20 +2,36 @@
 import functools
 import io
 import os
+import pickle
+import shutil
+import subprocess
+import sys
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import suppress
-from threading import Thread
-from time import sleep
-from typing import Any, Callable, Iterable, List, Mapping, Optional, TypedDict, Union
+from hashlib import blake2b
+from heapq import heappop, heappush
+from importlib.metadata import version
+from itertools import count
+from multiprocessing import get_context
+from pathlib import Path
+from random import uniform
+from tempfile import TemporaryDirectory
+from threading import BoundedSemaphore, Condition, Lock, Thread
+from time import monotonic, sleep
+from types import SimpleNamespace
+from typing import (
+    Any, Callable, Iterable, List, Mapping, Optional, Tuple, TypedDict, Union
+)
 from uuid import uuid4
 
-import strictyaml
 import structlog
-from guesslang import Guess
-from peewee import BooleanField, CharField, IntegerField
+import yaml
+from peewee import SQL, BooleanField, CharField, IntegerField
 from playhouse.kv import KeyValue
 from playhouse.sqliteq import SqliteQueueDatabase as SqliteDatabase
-from plumbum import local
-from plumbum.cmd import highlight, silicon
+from plumbum.cmd import highlight
 from requests.exceptions import ConnectionError
 from structlog.types import BindableLogger
 from telebot import TeleBot
@@ -26,31 +42,74 @@ from telebot.types import (
 )
 from wrapt import decorator
 
+try:
+    from yaml import CBaseLoader as YamlLoader
+except ImportError:
+    from yaml import BaseLoader as YamlLoader
+
+APP_DIR = Path(__file__).resolve().parent
+
 WraptFunc = Callable[[Callable, Any, Iterable, Mapping], Callable]
 
 
 # TODO: allow user entry of fallback group lang, checked against silicon.yml keys
 class Config(TypedDict):
-    lang: Mapping[str, str]
+    lang: SimpleNamespace
     kb: Mapping[str, InlineKeyboardMarkup]
     guesslang: Mapping[str, str]
     silicon: Mapping[str, str]
 
 
 def yload(yamltxt: str) -> Union[str, List, Mapping]:
-    return strictyaml.load(yamltxt).data
+    """Parse YAML, leaving all scalars as strings (as strictyaml did)"""
+    return yaml.load(yamltxt, Loader=YamlLoader)
+
 
+# Callback data is an action, followed by CB_SEP and an argument if it takes one
+CB_SEP = '\x1f'
+CB_BEGONE = 'begone'
+CB_BROWSE_GROUP_SYNTAX = 'browse group syntax'
+CB_TOGGLE_WATCH_MODE = 'toggle watch mode'
+CB_RESTORE = f'restore{CB_SEP}'
+CB_SET_EXT = f'set ext{CB_SEP}'
+CB_SET_DEFAULT_EXT = f'set default ext{CB_SEP}'
 
-def ydump(data: Mapping) -> str:
-    return strictyaml.as_document(data).as_yaml()
 
+def upgrade_cb_data(data: str) -> str:
+    """
+    Return callback data in the current format,
+    translating the YAML payloads (like 'action: begone') of older buttons,
+    which live on in chats indefinitely.
+    """
+    if not data.startswith('action:'):
+        return data
+    try:
+        legacy = yload(data)
+        action = legacy['action']
+    except (yaml.YAMLError, TypeError, KeyError):
+        return data
+    arg = legacy.get('ext', legacy.get('kb_name'))
+    return action if arg is None else f"{action}{CB_SEP}{arg}"
 
-BEGONE_BUTTON = InlineKeyboardButton('🗑️', callback_data=ydump({'action': 'begone'}))
+
+def cb_arg(data: str) -> str:
+    """Return the argument from callback data"""
+    return data.split(CB_SEP, 1)[1]
+
+
+BEGONE_BUTTON = InlineKeyboardButton('🗑️', callback_data=CB_BEGONE)
 
 BEGONE_KB = InlineKeyboardMarkup()
 BEGONE_KB.add(BEGONE_BUTTON)
 
-BG_IMAGE = str(local.path(__file__).up() / 'sharon-mccutcheon-33xSu0EWgP4-unsplash.jpg')
+SILICON_PATH = shutil.which('silicon') or 'silicon'
+
+BG_IMAGE = str(APP_DIR / 'sharon-mccutcheon-33xSu0EWgP4-unsplash.jpg')
+
+# Handlers run concurrently, so cap how many of them may be rendering at once.
+# Each slot covers one mk_pngs call, which runs a silicon process per theme,
+# and a private chat renders two themes; so allow about one process per CPU.
+RENDER_SLOTS = BoundedSemaphore(max(1, (os.cpu_count() or 1) // 2))
 
 
 def is_from_group_admin_or_creator(bot, message_or_query: Union[Message, CallbackQuery]):
@@ -66,56 +125,103 @@ def is_from_group_admin_or_creator(bot, message_or_query: Union[Message, Callbac
         ).status in ('administrator', 'creator')
 
 
-def load_configs() -> Config:
+def lang_namespace(lang: Mapping[str, str]) -> SimpleNamespace:
+    """Return the texts as attributes, with spaces in their keys made underscores"""
+    return SimpleNamespace(**{key.replace(' ', '_'): text for key, text in lang.items()})
+
+
+def config_cache_key(paths: Iterable[Union[str, Path]]) -> str:
+    """
+    Return a digest of the paths' identities, sizes, and modification times,
+    and of the Python and pyTelegramBotAPI versions the pickled objects depend on.
+    """
+    stats = [sys.version, version('pyTelegramBotAPI')]
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            stats.append((str(path), None, None))
+        else:
+            stats.append((str(path), st.st_mtime_ns, st.st_size))
+    return blake2b(repr(stats).encode()).hexdigest()
+
+
+def private_cache_dir(folder: Path) -> Optional[Path]:
+    """
+    Return the folder, created if needed, if only we own and can write to it.
+    Pickles are only safe to load from such a folder.
+    """
+    try:
+        folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+        st = folder.stat()
+    except OSError:
+        return None
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        return None
+    return folder
+
+
+def load_configs(cache_dir: Optional[str] = None) -> Config:
+    """
+    Return parsed configs and keyboards,
+    reusing a pickled copy from a previous run if no source file has changed.
+    """
+    ymls = [
+        APP_DIR / f'{yml}.yml' for yml in ('english', 'syntaxes', 'guesslang', 'silicon')
+    ]
+    if not cache_dir:
+        cache_dir = (
+            Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache')
+            / 'colorcodebot'
+        )
+    cache_dir = private_cache_dir(Path(cache_dir))
+    # This module is included so that code changes invalidate the cache, too
+    cache = (
+        cache_dir / f'{config_cache_key([*ymls, __file__])}.pkl' if cache_dir else None
+    )
+    if cache:
+        with suppress(OSError, EOFError, AttributeError, pickle.UnpicklingError):
+            with open(cache, 'rb') as f:
+                return pickle.load(f)
+
     data = {}
     (
         data['lang'],
         syntax_names_exts,
         data['guesslang'],
         data['silicon'],
-    ) = (
-        (
-            yload((local.path(__file__).up() / f'{yml}.yml').read())
-            if (local.path(__file__).up() / f'{yml}.yml').exists()
-            else {}
+    ) = (yload(yml.read_text()) if yml.exists() else {} for yml in ymls)
+    data['lang'] = lang_namespace(data['lang'])
+
+    # Both syntax keyboards list the same names, so gather their buttons in one pass
+    set_ext_buttons, set_default_ext_buttons = [], []
+    for name, ext in syntax_names_exts.items():
+        set_ext_buttons.append(
+            InlineKeyboardButton(name, callback_data=CB_SET_EXT + ext)
+        )
+        set_default_ext_buttons.append(
+            InlineKeyboardButton(name, callback_data=CB_SET_DEFAULT_EXT + ext)
         )
-        for yml in ('english', 'syntaxes', 'guesslang', 'silicon')
-    )
 
     kb_syntax = InlineKeyboardMarkup()
-    kb_syntax.add(
-        *[
-            InlineKeyboardButton(
-                name, callback_data=ydump({'action': 'set ext', 'ext': ext})
-            )
-            for name, ext in syntax_names_exts.items()
-        ],
-        BEGONE_BUTTON,
-    )
+    kb_syntax.add(*set_ext_buttons, BEGONE_BUTTON)
 
     kb_group_syntax = InlineKeyboardMarkup()
     kb_group_syntax.add(
-        *[
-            InlineKeyboardButton(
-                name, callback_data=ydump({'action': 'set default ext', 'ext': ext})
-            )
-            for name, ext in syntax_names_exts.items()
-        ],
-        InlineKeyboardButton(
-            "None", callback_data=ydump({'action': 'set default ext', 'ext': ''})
-        ),
+        *set_default_ext_buttons,
+        InlineKeyboardButton("None", callback_data=CB_SET_DEFAULT_EXT),
         BEGONE_BUTTON,
     )
 
     kb_group_options = InlineKeyboardMarkup()
     kb_group_options.add(
         InlineKeyboardButton(
-            data['lang']['select default syntax'],
-            callback_data=ydump({'action': 'browse group syntax'}),
+            data['lang'].select_default_syntax,
+            callback_data=CB_BROWSE_GROUP_SYNTAX,
         ),
         InlineKeyboardButton(
-            data['lang']['toggle watch mode'],
-            callback_data=ydump({'action': 'toggle watch mode'}),
+            data['lang'].toggle_watch_mode,
+            callback_data=CB_TOGGLE_WATCH_MODE,
         ),
         BEGONE_BUTTON,
     )
@@ -126,41 +232,132 @@ def load_configs() -> Config:
         'group syntax': kb_group_syntax,
     }
 
-    return data
+    if cache:
+        with suppress(OSError):
+            partial = cache.with_suffix(f'.{os.getpid()}.tmp')
+            with open(partial, 'wb') as f:
+                pickle.dump(data, f)
+            os.replace(partial, cache)
+            for stale in cache_dir.glob('*.pkl'):
+                if stale != cache:
+                    stale.unlink(missing_ok=True)
 
+    return data
 
-def mk_png(code: str, ext: str, theme: str = 'Coldark-Dark', folder=None) -> str:
-    """Return generated PNG file path"""
-    folder = (local.path(folder) if folder else local.path('/tmp/ccb_png')) / uuid4()
-    folder.mkdir()
 
+def mk_pngs(code: str, ext: str, themes: Iterable[str], folder=None) -> List[bytes]:
+    """
+    Return generated PNG data for each theme, running silicon for all at once.
+    Silicon picks its output format by file extension, so it can't render to stdout;
+    the PNGs pass through a scratch folder, created within folder if given.
+    """
     # TODO: test all ext values...
 
-    png = folder / f'{uuid4()}.png'
+    with RENDER_SLOTS, TemporaryDirectory(dir=folder) as scratch:
+        pngs = []
+        procs = []
+        for theme in themes:
+            png = os.path.join(scratch, f'{len(pngs)}.png')
+            # fmt: off
+            cmd = [
+                SILICON_PATH,
+                '-o', png,
+                '-l', ext,
+                '--theme', theme,
+                '--pad-horiz', '20',
+                '--pad-vert', '25',
+                '--shadow-blur-radius', '5',
+                '--background-image', BG_IMAGE,
+                '-f', '; '.join((
+                    'Iosevka Term Custom',
+                    'Symbols Nerd Font Mono',
+                    'OpenMoji',
+                    'NanumGothicCoding',
+                )),
+            ]
+            # fmt: on
+            pngs.append(png)
+            procs.append(subprocess.Popen(cmd, stdin=subprocess.PIPE))
+
+        # Feed every process before waiting on any, so they all render together
+        for proc in procs:
+            try:
+                proc.stdin.write(code.encode())
+            except BrokenPipeError:  # silicon exited early; checked below
+                pass
+            finally:
+                with suppress(BrokenPipeError):
+                    proc.stdin.close()
+        for proc in procs:
+            proc.wait()
+        for proc in procs:
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+        data = []
+        for png in pngs:
+            with open(png, 'rb') as f:
+                data.append(f.read())
+        return data
+
+
+def mk_png(code: str, ext: str, theme: str = 'Coldark-Dark', folder=None) -> bytes:
+    """Return generated PNG data"""
+    return mk_pngs(code, ext, [theme], folder=folder)[0]
+
+
+# Where one prefix starts another, the longer must come first
+SIMPLE_SYNTAX_PREFIXES = {
     # fmt: off
-    (
-        silicon[
-            '-o', png,
-            '-l', ext,
-            '--theme', theme,
-            '--pad-horiz', 20,
-            '--pad-vert', 25,
-            '--shadow-blur-radius', 5,
-            '--background-image', BG_IMAGE,
-            '-f', '; '.join((
-                'Iosevka Term Custom',
-                'Symbols Nerd Font Mono',
-                'OpenMoji',
-                'NanumGothicCoding',
-            ))
-        ]
-        << code
-    )()
+    '{':     'json',
+    '---\n': 'yaml',
+    '--- ':  'diff',
+    '-- ':   'lua',
+    '\\':    'tex',
+    '%%':    'tex',
+    '[[':    'toml', '[': 'ini',
+    '<?php': 'php',  '<': 'xml',
+    '! ': 'factor',
+    ': ': 'factor',
+    'USING: ': 'factor',
+    'IN: ': 'factor',
     # fmt: on
+}
+
+SIMPLE_SYNTAX_PREFIXES_BY_FIRST_CHAR = defaultdict(list)
+for prefix, ext in SIMPLE_SYNTAX_PREFIXES.items():
+    SIMPLE_SYNTAX_PREFIXES_BY_FIRST_CHAR[prefix[0]].append((prefix, ext))
+
 
-    return str(png)
+def simple_guess_ext(code: str) -> Optional[str]:
+    """Return the ext indicated by a well-known start of the code, if any"""
+    for prefix, ext in SIMPLE_SYNTAX_PREFIXES_BY_FIRST_CHAR.get(code[:1], ()):
+        if code.startswith(prefix):
+            return ext
+
+
+_guesser = None
+
+
+def load_guesser():
+    """
+    Load guesslang's model into this (worker) process, if not already loaded.
+    Importing guesslang pulls in TensorFlow, so that's deferred to here as well.
+    """
+    global _guesser
+    if _guesser is None:
+        from guesslang import Guess
 
+        _guesser = Guess()
 
+
+def guess_top_syntax(code: str) -> Tuple[str, float]:
+    """Return guesslang's most probable (syntax, probability) for the code"""
+    load_guesser()
+    return _guesser.probabilities(code)[0]
+
+
+@functools.lru_cache(maxsize=32)
 def minikb(kb_name: str, mini_text: str = '. . .') -> InlineKeyboardMarkup:
     """
     Return an inline KB with just one button,
@@ -168,9 +365,7 @@ def minikb(kb_name: str, mini_text: str = '. . .') -> InlineKeyboardMarkup:
     """
     kb = InlineKeyboardMarkup()
     kb.add(
-        InlineKeyboardButton(
-            mini_text, callback_data=ydump({'action': 'restore', 'kb_name': kb_name})
-        ),
+        InlineKeyboardButton(mini_text, callback_data=CB_RESTORE + kb_name),
         BEGONE_BUTTON,
     )
     return kb
@@ -180,11 +375,23 @@ def retry(
     original: Callable = None,  # needed to make args altogether optional
     exceptions: Union[Exception, Iterable[Exception]] = ConnectionError,
     attempts: int = 6,
-    seconds: float = 3,
+    seconds: float = 0.3,
+    max_seconds: float = 30,
+    deadline: float = 60,
 ) -> Union[WraptFunc, functools.partial[WraptFunc]]:
+    """
+    Retry on the given (network) exceptions only, with jittered exponential backoff
+    starting from seconds, each wait capped at max_seconds,
+    and no new attempt once deadline seconds have passed.
+    """
     if not original:  # needed to make args altogether optional
         return functools.partial(
-            retry, exceptions=exceptions, attempts=attempts, seconds=seconds
+            retry,
+            exceptions=exceptions,
+            attempts=attempts,
+            seconds=seconds,
+            max_seconds=max_seconds,
+            deadline=deadline,
         )
 
     @decorator
@@ -193,6 +400,7 @@ def retry(
         last_error = None
         if has_logger:
             log = instance.log.bind(method=original.__name__)
+        give_up_at = monotonic() + deadline
         for attempt in range(attempts):
             try:
                 resp = original(*args, **kwargs)
@@ -201,12 +409,15 @@ def retry(
                 if has_logger:
                     log = log.bind(exc_info=e)
                     # exc_info will get overwritten by most recent attempt
-                sleep(seconds)
+                delay = min(max_seconds, seconds * 2**attempt) * uniform(0.5, 1.5)
+                if attempt + 1 == attempts or monotonic() + delay > give_up_at:
+                    break
+                sleep(delay)
             else:
                 last_error = None
                 break
-            if has_logger and attempt > 0:
-                log.msg("called retry-able", retries=attempt, success=not last_error)
+        if has_logger and (attempt > 0 or last_error):
+            log.msg("called retry-able", retries=attempt, success=not last_error)
         if last_error:
             raise last_error
         return resp
@@ -229,9 +440,40 @@ def mk_logger(json=True) -> BindableLogger:
     return structlog.get_logger()
 
 
+class DelayedCalls:
+    """Run functions after a delay, all from one shared daemon thread"""
+
+    def __init__(self, log: Optional[BindableLogger] = None):
+        self.log = log
+        self._calls = []  # heap of (deadline, tiebreaker, func, args)
+        self._tiebreakers = count()
+        self._cond = Condition()
+        Thread(target=self._run, daemon=True).start()
+
+    def call_later(self, delay: float, func: Callable, *args: Any):
+        with self._cond:
+            heappush(
+                self._calls, (monotonic() + delay, next(self._tiebreakers), func, args)
+            )
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._calls or self._calls[0][0] > monotonic():
+                    self._cond.wait(
+                        self._calls[0][0] - monotonic() if self._calls else None
+                    )
+                _, _, func, args = heappop(self._calls)
+            try:
+                func(*args)
+            except Exception as e:
+                if self.log:
+                    self.log.error("delayed call failed", exc_info=e, func=func.__name__)
+
+
 @retry
-def delete_after_delay(bot, message, delay=60, log: Optional[BindableLogger] = None):
-    sleep(delay)
+def delete_msg(bot, message, log: Optional[BindableLogger] = None):
     try:
         bot.delete_message(message.chat.id, message.message_id)
     except ApiException as e:
@@ -245,14 +487,14 @@ def delete_after_delay(bot, message, delay=60, log: Optional[BindableLogger] = N
 
 @retry
 def send_image(
-    bot, chat_id, png_path: str, reply_msg_id=None, log: Optional[BindableLogger] = None
+    bot, chat_id, png: bytes, reply_msg_id=None, log: Optional[BindableLogger] = None
 ) -> Message:
     bot.send_chat_action(chat_id, 'upload_photo')
 
-    if local.path(png_path).stat().st_size < 300000:
+    doc = io.BytesIO(png)
+    if len(png) < 300000:
         try:
-            with open(png_path, 'rb') as doc:
-                return bot.send_photo(chat_id, doc, reply_to_message_id=reply_msg_id)
+            return bot.send_photo(chat_id, doc, reply_to_message_id=reply_msg_id)
         except ApiException as e:
             if log:
                 log.error(
@@ -260,9 +502,24 @@ def send_image(
                     exc_info=e,
                     chat_id=chat_id,
                 )
+        doc.seek(0)
+
+    return bot.send_document(
+        chat_id,
+        doc,
+        reply_to_message_id=reply_msg_id,
+        visible_file_name='colorcode.png',
+    )
+
 
-    with open(png_path, 'rb') as doc:
-        return bot.send_document(chat_id, doc, reply_to_message_id=reply_msg_id)
+def prune_kv(kv: KeyValue, max_rows: int) -> int:
+    """
+    Delete all but the newest max_rows entries, returning how many were deleted.
+    Entries are ordered by rowid, i.e. by when their keys were first stored.
+    """
+    rowid = SQL('rowid')
+    oldest_kept = kv.model.select(rowid).order_by(rowid.desc()).offset(max_rows - 1)
+    return kv.model.delete().where(rowid < oldest_kept.limit(1)).execute()
 
 
 def code_subcontent(message: Message) -> Optional[str]:
@@ -280,12 +537,16 @@ class ColorCodeBot:
     def __init__(
         self,
         api_key: str,
-        lang: Mapping[str, str],
+        lang: SimpleNamespace,
         keyboards: Mapping[str, InlineKeyboardMarkup],
         guesslang_syntaxes: Mapping[str, str],
         silicon_syntaxes: Mapping[str, str],
         *args: Any,
-        db_path: str = str(local.path(__file__).up() / 'db-files' / 'ccb.sqlite'),
+        db_path: str = str(APP_DIR / 'db-files' / 'ccb.sqlite'),
+        db_synchronous: str = 'normal',
+        num_threads: int = 16,
+        cache_rows: int = 100000,
+        cache_prune_seconds: float = 3600,
         **kwargs: Any,
     ):
         self.lang = lang
@@ -293,8 +554,18 @@ class ColorCodeBot:
         self.guesslang_syntaxes = guesslang_syntaxes
         self.silicon_syntaxes = silicon_syntaxes
         self.log = mk_logger()
+        self.delayed_calls = DelayedCalls(log=self.log)
         self.db_path = db_path
-        self.db = SqliteDatabase(self.db_path)
+        self.db = SqliteDatabase(
+            self.db_path,
+            pragmas={
+                'journal_mode': 'wal',
+                # In WAL mode, 'normal' skips the fsync on each commit,
+                # risking only the latest commits on power loss
+                'synchronous': db_synchronous,
+                'cache_size': -64000,  # KiB
+            },
+        )
         self.group_syntaxes = KeyValue(
             key_field=IntegerField(primary_key=True),
             value_field=CharField(),
@@ -313,9 +584,59 @@ class ColorCodeBot:
             database=self.db,
             table_name='group_user_current_watchme_request',
         )
-        self.bot = TeleBot(api_key, *args, **kwargs)
+        self.guess_cache = KeyValue(
+            key_field=CharField(primary_key=True),
+            database=self.db,
+            table_name='guesslang_result',
+        )
+        self.png_file_ids = KeyValue(
+            key_field=CharField(primary_key=True),
+            value_field=CharField(),
+            database=self.db,
+            table_name='png_file_id',
+        )
+        self.cache_rows = cache_rows
+        self.cache_prune_seconds = cache_prune_seconds
+        self.prune_caches()
+        # Handlers mostly wait on Telegram, so many can usefully be in flight at once
+        self.bot = TeleBot(api_key, *args, num_threads=num_threads, **kwargs)
         self.register_handlers()
-        self.guesser = Guess()
+        self.guess_pool_lock = Lock()
+        self.guess_pool = None
+        self.start_guess_pool()
+        self.guess_syntax = functools.lru_cache(maxsize=512)(self.guess_syntax)
+
+    def start_guess_pool(self, broken: Optional[ProcessPoolExecutor] = None):
+        """
+        Start the guesslang worker process,
+        or replace the broken pool if another thread hasn't already.
+        """
+        with self.guess_pool_lock:
+            if broken:
+                if self.guess_pool is not broken:
+                    return
+                broken.shutdown(wait=False, cancel_futures=True)
+            # Each worker holds its own copy of the TensorFlow model, so just one.
+            # Forking would copy this process mid-flight, with its threads' locks.
+            self.guess_pool = ProcessPoolExecutor(
+                max_workers=1, mp_context=get_context('forkserver')
+            )
+            # Start loading the model now, in the background, rather than on first guess
+            self.guess_pool.submit(load_guesser).add_done_callback(self.log_guesser_load)
+
+    def prune_caches(self):
+        """Keep the content-keyed caches from growing forever, now and periodically"""
+        self.delayed_calls.call_later(self.cache_prune_seconds, self.prune_caches)
+        for kv in (self.guess_cache, self.png_file_ids):
+            pruned = prune_kv(kv, self.cache_rows)
+            if pruned:
+                self.log.msg(
+                    "pruned cache", table=kv.model._meta.table_name, rows=pruned
+                )
+
+    def log_guesser_load(self, load: Future):
+        if not load.cancelled() and load.exception():
+            self.log.error("failed to load guesslang model", exc_info=load.exception())
 
     def register_handlers(self):
         # fmt: off
@@ -324,15 +645,30 @@ class ColorCodeBot:
         self.ignore_group_user    = self.bot.message_handler(commands=['ignoreme'])(self.ignore_group_user)
         self.watch_group_user     = self.bot.message_handler(commands=['watchme'])(self.watch_group_user)
         self.intake_snippet       = self.bot.message_handler(func=lambda m: m.content_type == 'text')(self.intake_snippet)
-        self.restore_kb           = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'restore')(self.restore_kb)
-        self.set_snippet_filetype = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'set ext')(self.set_snippet_filetype)
-        self.set_group_syntax     = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'set default ext')(self.set_group_syntax)
-        self.browse_group_syntax  = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'browse group syntax')(self.browse_group_syntax)
-        self.toggle_group_watch   = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'toggle watch mode')(self.toggle_group_watch)
-        self.begone               = self.bot.callback_query_handler(lambda q: yload(q.data)['action'] == 'begone')(self.begone)
+        self.dispatch_callback    = self.bot.callback_query_handler(lambda q: True)(self.dispatch_callback)
         self.send_photo_elsewhere = self.bot.inline_handler(lambda q: q.query.startswith("img "))(self.send_photo_elsewhere)
         self.switch_from_inline   = self.bot.inline_handler(lambda q: True)(self.switch_from_inline)
         # fmt: on
+        self.callback_handlers = {
+            CB_RESTORE: self.restore_kb,
+            CB_SET_EXT: self.set_snippet_filetype,
+            CB_SET_DEFAULT_EXT: self.set_group_syntax,
+            CB_BROWSE_GROUP_SYNTAX: self.browse_group_syntax,
+            CB_TOGGLE_WATCH_MODE: self.toggle_group_watch,
+            CB_BEGONE: self.begone,
+        }
+
+    def dispatch_callback(self, cb_query: CallbackQuery):
+        """Route the query to its handler by the action at the start of its data"""
+        cb_query.data = upgrade_cb_data(cb_query.data)
+        action, sep, _ = cb_query.data.partition(CB_SEP)
+        handler = self.callback_handlers.get(action + sep)
+        if handler:
+            handler(cb_query)
+        else:
+            self.log.msg("ignoring unknown callback", data=cb_query.data)
+            # Otherwise the client keeps showing its loading indicator
+            self.bot.answer_callback_query(cb_query.id)
 
     @retry
     def switch_from_inline(self, inline_query: InlineQuery):
@@ -345,7 +681,7 @@ class ColorCodeBot:
         self.bot.answer_inline_query(
             inline_query.id,
             [],
-            switch_pm_text=self.lang['switch to direct'],
+            switch_pm_text=self.lang.switch_to_direct,
             switch_pm_parameter='x',
         )
 
@@ -359,16 +695,16 @@ class ColorCodeBot:
         )
         self.bot.reply_to(
             message,
-            self.lang['welcome'],
+            self.lang.welcome,
             parse_mode='MarkdownV2',
             reply_markup=ForceReply(
-                input_field_placeholder=self.lang['input field placeholder']
+                input_field_placeholder=self.lang.input_field_placeholder
             ),
         )
 
     @retry
     def get_group_config_md(self, chat_id):
-        return self.lang['current config'].format(
+        return self.lang.current_config.format(
             default_syntax=str(self.group_syntaxes.get(chat_id)),
             ignore_mode=(
                 "ignore" if self.ignore_mode_groups.get(chat_id, False) else "watch"
@@ -410,9 +746,13 @@ class ColorCodeBot:
             user_is_admin=is_admin_or_creator,
         )
         if is_admin_or_creator:
-            self.ignore_mode_groups[cb_query.message.chat.id] = (
-                not self.ignore_mode_groups.get(cb_query.message.chat.id, False)
-            )
+            # Toggle in one upsert, as SqliteQueueDatabase doesn't support transactions
+            self.ignore_mode_groups.model.insert(
+                key=cb_query.message.chat.id, value=True
+            ).on_conflict(
+                conflict_target=[self.ignore_mode_groups.key],
+                update={self.ignore_mode_groups.value: ~self.ignore_mode_groups.value},
+            ).execute()
             self.bot.edit_message_text(
                 self.get_group_config_md(cb_query.message.chat.id),
                 cb_query.message.chat.id,
@@ -471,8 +811,27 @@ class ColorCodeBot:
                 if lang:
                     return self.silicon_syntaxes.get(lang)
 
+    def guess_syntax(self, code: str, timeout: float = 30) -> Tuple[str, float]:
+        """
+        Return guesslang's most probable (syntax, probability) for the code,
+        from the database if it's been seen before.
+        """
+        digest = blake2b(code.encode(), digest_size=16).hexdigest()
+        with suppress(KeyError):
+            return self.guess_cache[digest]
+        guess = self.guess_pool.submit(guess_top_syntax, code).result(timeout=timeout)
+        self.guess_cache[digest] = guess
+        return guess
+
     def guess_ext(self, code: str, probability_min: float = 0.12) -> Optional[str]:
-        syntax, probability = self.guesser.probabilities(code)[0]
+        pool = self.guess_pool
+        try:
+            syntax, probability = self.guess_syntax(code.strip()[:4096])
+        except Exception as e:
+            self.log.error("failed to guess syntax", exc_info=e)
+            syntax, probability = None, 0
+            if isinstance(e, BrokenProcessPool):
+                self.start_guess_pool(broken=pool)
         ext = self.guesslang_syntaxes.get(syntax)
         self.log.msg(
             "guessed syntax",
@@ -483,25 +842,10 @@ class ColorCodeBot:
         )
         if probability >= probability_min:
             return ext
-        for start, ext in {
-            # fmt: off
-            '{':     'json',
-            '---\n': 'yaml',
-            '--- ':  'diff',
-            '-- ':   'lua',
-            '\\':    'tex',
-            '%%':    'tex',
-            '[[':    'toml', '[': 'ini',
-            '<?php': 'php',  '<': 'xml',
-            '! ': 'factor',
-            ': ': 'factor',
-            'USING: ': 'factor',
-            'IN: ': 'factor',
-            # fmt: on
-        }.items():
-            if code.startswith(start):
-                self.log.msg("simple-guessed syntax", ext=ext)
-                return ext
+        ext = simple_guess_ext(code)
+        if ext:
+            self.log.msg("simple-guessed syntax", ext=ext)
+            return ext
 
     @retry
     def intake_snippet(self, message: Message):
@@ -543,8 +887,8 @@ class ColorCodeBot:
         if ext:
             kb_msg = self.bot.reply_to(
                 message,
-                f"{self.lang['query ext']}\n\n{self.lang['guessed syntax'].format(ext)}",
-                reply_markup=minikb('syntax', self.lang['syntax picker']),
+                f"{self.lang.query_ext}\n\n{self.lang.guessed_syntax.format(ext)}",
+                reply_markup=minikb('syntax', self.lang.syntax_picker),
                 parse_mode='MarkdownV2',
                 disable_web_page_preview=True,
             )
@@ -552,12 +896,12 @@ class ColorCodeBot:
         else:
             kb_msg = self.bot.reply_to(
                 message,
-                self.lang['query ext'],
+                self.lang.query_ext,
                 reply_markup=self.kb['syntax'],
                 parse_mode='MarkdownV2',
                 disable_web_page_preview=True,
             )
-        Thread(target=delete_after_delay, args=(self.bot, kb_msg, 30, self.log)).start()
+        self.delayed_calls.call_later(30, delete_msg, self.bot, kb_msg, self.log)
 
     @retry
     def send_photo_elsewhere(self, inline_query: InlineQuery):
@@ -579,17 +923,17 @@ class ColorCodeBot:
 
     @retry
     def restore_kb(self, cb_query: CallbackQuery):
-        data = yload(cb_query.data)
+        kb_name = cb_arg(cb_query.data)
         self.bot.edit_message_reply_markup(
             cb_query.message.chat.id,
             cb_query.message.message_id,
-            reply_markup=self.kb[data['kb_name']],
+            reply_markup=self.kb[kb_name],
         )
         self.bot.answer_callback_query(cb_query.id)
 
     @retry
     def set_group_syntax(self, cb_query: CallbackQuery):
-        ext = yload(cb_query.data)['ext']
+        ext = cb_arg(cb_query.data)
         is_admin_or_creator = is_from_group_admin_or_creator(self.bot, cb_query)
         self.log.msg(
             "user trying to set group default syntax",
@@ -620,11 +964,11 @@ class ColorCodeBot:
     ):
         if cb_query:
             query_message = cb_query.message
-            ext = yload(cb_query.data)['ext']
+            ext = cb_arg(cb_query.data)
             self.bot.edit_message_reply_markup(
                 query_message.chat.id,
                 query_message.message_id,
-                reply_markup=minikb('syntax', self.lang['syntax picker']),
+                reply_markup=minikb('syntax', self.lang.syntax_picker),
             )
             snippet = query_message.reply_to_message
         elif not (snippet and ext):
@@ -649,29 +993,54 @@ class ColorCodeBot:
             themes.append('Coldark-Dark')
         if do_send_image_light:
             themes.append('Coldark-Cold')
-        with local.tempdir() as folder:
-            for theme in themes:
-                png_path = mk_png(text_content, ext, theme, folder=folder)
+        png_keys = {
+            theme: blake2b(
+                f"{ext}|{theme}|{text_content}".encode(), digest_size=16
+            ).hexdigest()
+            for theme in themes
+        }
+        file_ids = {theme: self.png_file_ids.get(png_keys[theme]) for theme in themes}
+        unsent = [theme for theme in themes if not file_ids[theme]]
+        pngs = dict(zip(unsent, mk_pngs(text_content, ext, unsent))) if unsent else {}
+        # Send in theme order, though the renders themselves run concurrently
+        for theme in themes:
+            photo_msg = None
+            if file_ids[theme]:
+                try:
+                    photo_msg = self.bot.send_photo(
+                        snippet.chat.id,
+                        file_ids[theme],
+                        reply_to_message_id=snippet.message_id,
+                    )
+                except ApiException as e:
+                    self.log.error(
+                        "failed to resend image by file_id", exc_info=e, theme=theme
+                    )
+                    del self.png_file_ids[png_keys[theme]]
+                    pngs[theme] = mk_png(text_content, ext, theme)
+            if not photo_msg:
                 photo_msg = send_image(
                     bot=self.bot,
                     chat_id=snippet.chat.id,
-                    png_path=png_path,
+                    png=pngs[theme],
                     reply_msg_id=snippet.message_id,
                 )
-                image_kb = InlineKeyboardMarkup()
-                if do_attach_send_kb and photo_msg.content_type == 'photo':
-                    image_kb.add(
-                        InlineKeyboardButton(
-                            self.lang['send to chat'],
-                            switch_inline_query=f"img {photo_msg.photo[-1].file_id}",
-                        )
+                if photo_msg.content_type == 'photo':
+                    self.png_file_ids[png_keys[theme]] = photo_msg.photo[-1].file_id
+            image_kb = InlineKeyboardMarkup()
+            if do_attach_send_kb and photo_msg.content_type == 'photo':
+                image_kb.add(
+                    InlineKeyboardButton(
+                        self.lang.send_to_chat,
+                        switch_inline_query=f"img {photo_msg.photo[-1].file_id}",
                     )
-                image_kb.add(BEGONE_BUTTON)
-                self.bot.edit_message_reply_markup(
-                    photo_msg.chat.id,
-                    photo_msg.message_id,
-                    reply_markup=image_kb,
                 )
+            image_kb.add(BEGONE_BUTTON)
+            self.bot.edit_message_reply_markup(
+                photo_msg.chat.id,
+                photo_msg.message_id,
+                reply_markup=image_kb,
+            )
 
         if cb_query:
             self.bot.answer_callback_query(cb_query.id)
@@ -685,4 +1054,5 @@ if __name__ == '__main__':
         keyboards=cfg['kb'],
         guesslang_syntaxes=cfg['guesslang'],
         silicon_syntaxes=cfg['silicon'],
+        db_synchronous=os.environ.get('DB_SYNCHRONOUS', 'normal'),
     ).bot.polling()